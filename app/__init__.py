@@ -1,14 +1,18 @@
-from flask import Flask
-from flask_cors import CORS
+from quart import Quart
+from quart_cors import cors
 from config import Config
+from app.services import ai_service
 
 def create_app():
-    app = Flask(__name__)
+    app = Quart(__name__)
     app.config.from_object(Config)
-    CORS(app)
+    app = cors(app)
+
+    # The OpenAI client (and its connection pool) lives as long as the server
+    app.after_serving(ai_service.close_client)
 
     # Register blueprints
     from app.routes.main import main_bp
     app.register_blueprint(main_bp)
 
-    return app 
\ No newline at end of file
+    return app
@@ -1,19 +1,62 @@
-from flask import Blueprint, request, jsonify
+from quart import Blueprint, Response, request, jsonify, stream_with_context
 import asyncio  # Import asyncio
+import hashlib
+import os
+from diskcache import Cache
+from config import Config
+from app.services.ai_service import AIReconciliationService
 from app.services.file_processor import ReconciliationProcessor
+from app.utils.serialization import dumps
 from app.utils.validators import allowed_file
 
 main_bp = Blueprint('main', __name__)
 
 ALLOWED_EXTENSIONS = {'csv', 'xlsx', 'xls'}
+STREAM_THRESHOLD = 5000  # Results with more transactions than this are streamed row by row
+
+# Re-uploading the same two files returns the earlier results, for up to a day
+RESULT_CACHE_EXPIRE = 86400
+_reconcile_cache = Cache(os.path.join(Config.CACHE_FOLDER, 'reconcile'))
+
+def file_hash(file):
+    """Hashes an uploaded file in blocks, then rewinds it for the processor."""
+    digest = hashlib.blake2b(digest_size=16)
+    for block in iter(lambda: file.stream.read(1 << 20), b''):
+        digest.update(block)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+def json_response(results, status=200):
+    """Serializes results with orjson; large reconciliation results are streamed instead of buffered."""
+    categories = ('green', 'yellow', 'red')
+    if not set(categories) <= set(results) or sum(len(results[category]) for category in categories) <= STREAM_THRESHOLD:
+        return Response(dumps(results), status=status, mimetype='application/json')
+
+    @stream_with_context
+    async def generate():
+        yield b'{'
+        # Small fields (job_id, batch status) first, then the transactions row by row
+        for key, value in results.items():
+            if key not in categories:
+                yield dumps(key) + b':' + dumps(value) + b','
+        for i, category in enumerate(categories):
+            yield b'%s"%s":[' % (b',' if i else b'', category.encode())
+            for j, item in enumerate(results[category]):
+                yield (b',' if j else b'') + dumps(item)
+            yield b']'
+        yield b'}'
+
+    return Response(generate(), status=status, mimetype='application/json')
 
 @main_bp.route('/api/upload', methods=['POST'])
-async def upload_files():  # Make this an async function
-    if 'bank_statement' not in request.files or 'company_book' not in request.files:
+async def upload_files():
+    files = await request.files
+    form = await request.form
+    if 'bank_statement' not in files or 'company_book' not in files:
         return jsonify({'error': 'Both files are required'}), 400
     
-    bank_file = request.files['bank_statement']
-    book_file = request.files['company_book']
+    bank_file = files['bank_statement']
+    book_file = files['company_book']
     
     if not (bank_file and allowed_file(bank_file.filename, ALLOWED_EXTENSIONS) and 
             book_file and allowed_file(book_file.filename, ALLOWED_EXTENSIONS)):
@@ -22,8 +65,39 @@ async def upload_files():  # Make this an async function
     try:
         processor = ReconciliationProcessor()
 
-        # Run async function properly
+        # Large uploads can go through the cheaper Batch API and be polled at /api/results/<batch_id>
+        if form.get('mode') == 'batch':
+            results = await processor.process_files_with_batch(bank_file, book_file)
+            return json_response(results, 202 if 'batch_id' in results else 200)
+
+        bank_hash = await asyncio.to_thread(file_hash, bank_file)
+        book_hash = await asyncio.to_thread(file_hash, book_file)
+        job_key = f"{bank_hash}:{book_hash}"
+        results = await asyncio.to_thread(_reconcile_cache.get, job_key)
+        if results is not None:
+            print(f"Returning cached reconciliation {job_key}")
+            return json_response(results)
+
         results = await processor.process_files_with_ai(bank_file, book_file)
-        return jsonify(results), 200  # Return results as JSON
+        # A chunk the AI failed on (outage, rate limit) is all red; don't serve that again
+        if processor.ai_service.failed_chunks:
+            print(f"Not caching reconciliation {job_key}: {processor.ai_service.failed_chunks} chunks failed")
+        else:
+            await asyncio.to_thread(_reconcile_cache.set, job_key, results, expire=RESULT_CACHE_EXPIRE)
+        return json_response(results)  # Return results as JSON
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@main_bp.route('/api/results/<batch_id>', methods=['GET'])
+async def batch_results(batch_id):
+    try:
+        results = await AIReconciliationService().fetch_batch_results(batch_id)
+        if results is None:
+            return jsonify({'error': 'Unknown batch'}), 404
+
+        # Still running: the client should poll again later
+        if 'status' in results:
+            return json_response(results, 202)
+        return json_response(results)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1,202 +1,802 @@
 import os
-import json
 import openai
+import orjson
 import asyncio
+import functools
+import hashlib
+import math
+import pickle
+import random
+import time
+import uuid
+import httpx
+import json_repair
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from diskcache import Cache
 from dotenv import load_dotenv
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import logging
-from datetime import datetime
+from datetime import date
+from config import Config
+from app.utils.serialization import dumps
+from . import matcher
 
 load_dotenv()
 
 # Set logging level to suppress debug messages
 logging.getLogger("openai").setLevel(logging.WARNING)
 
+# Columns in [date, narration, outflow, inflow] order, as expected by the matcher
+BANK_COLUMNS = ['Date', 'Narration', 'Withdrawal Amt.', 'Deposit Amt.']
+BOOK_COLUMNS = ['date', 'transaction_details', 'debit', 'credit']
+
+# Transactions are sent to the AI as tables of row arrays; these name the columns, in the same order
+TABLE_COLUMNS = ['d', 'n', 'w', 'c']
+
+# Structured output schema of a chunk's answer; with strict mode the response always parses
+_ROW_SCHEMA = {"type": "array", "items": {"anyOf": [{"type": "string"}, {"type": "number"}, {"type": "null"}]}}
+_PAIR_SCHEMA = {
+    "type": "object",
+    "properties": {"bank": _ROW_SCHEMA, "book": _ROW_SCHEMA},
+    "required": ["bank", "book"],
+    "additionalProperties": False,
+}
+MATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "green": {"type": "array", "items": _PAIR_SCHEMA},
+        "yellow": {"type": "array", "items": _PAIR_SCHEMA},
+        "red": {
+            "type": "object",
+            "properties": {"bank": {"type": "array", "items": _ROW_SCHEMA}, "book": {"type": "array", "items": _ROW_SCHEMA}},
+            "required": ["bank", "book"],
+            "additionalProperties": False,
+        },
+    },
+    "required": ["green", "yellow", "red"],
+    "additionalProperties": False,
+}
+
+# One record per combined result entry; row indices are -1 for the side a red entry doesn't have
+RESULT_DTYPE = np.dtype([("bank_idx", "i4"), ("book_idx", "i4"), ("category", "u1"), ("score", "f4")])
+RESULTS_FOLDER = os.path.join(Config.CACHE_FOLDER, 'results')
+RESULTS_EXPIRE = 7 * 86400  # Saved results are deleted after a week
+
+# Identical prompts get identical answers, so responses are kept on disk for a week
+RESPONSE_CACHE_EXPIRE = 7 * 86400
+_response_cache = Cache(os.path.join(Config.CACHE_FOLDER, 'openai'))
+
+# Chunks are sent concurrently, bounded to stay under the account's rate limit
+MAX_CONCURRENT_REQUESTS = 10
+MAX_CONNECTIONS = 32
+RATE_LIMIT_RETRIES = 5
+
+# Batch jobs complete within 24h; their rule-based results are kept until then
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_FAILED_STATUSES = {"failed", "expired", "cancelled"}
+_batch_jobs = Cache(os.path.join(Config.CACHE_FOLDER, 'batches'))
+
+
+# The system prompt is identical for every request and is always the first message, so
+# OpenAI's automatic prompt caching (shared prefixes of 1024+ tokens) can reuse it across
+# chunks. Keep it free of per-request content and above that size.
+_SYSTEM_PROMPT = """You are an expert in financial reconciliation handling large datasets mostly CSV.
+Your goal is to match bank transactions with book records. The transactions you are given have already been through a rule-based matcher; what is left are the harder cases, so read every narration carefully.
+
+## Input
+
+Each request contains two tables, "Bank Transactions" (from the bank statement) and "Book Transactions" (from the company's books), each followed by a "Counts" list.
+- A table is {"cols": ["d", "n", "w", "c"], "rows": [[...], [...]]}. Every row is one transaction given as an array of four values, in the order of "cols".
+- "d" is the date, "n" the narration (transaction details), "w" the withdrawal or debit amount and "c" the deposit or credit amount.
+- A bank withdrawal corresponds to a book debit and a bank deposit corresponds to a book credit, so both are in the same column. Only one of the two amount columns is normally filled in; an empty, null or zero value means no amount on that side.
+- Counts: the number at position i of a Counts list is how many identical copies of row i exist. Identical transactions are sent once to keep requests small. A row with count k stands for k transactions: it may appear in up to k green or yellow pairs (for example two identical ATM withdrawals matching two book entries on different dates). A pair that holds every copy of both of its rows, or a row in red, is listed once; the copies are restored afterwards.
+- Dates may be ISO 8601 ("2024-03-01T00:00:00"), or day-first ("01/03/24", "01-03-2024"). Bank statements in this system use day-first dates; never read them month-first.
+
+## Matching rules
+
+- Date Matching: Transactions can be matched with up to a 5-day difference. Book entries are often recorded before the bank clears them (cheques, transfers initiated at month end), so a book date a few days before the bank date is normal.
+- Amount Matching: Accept minor rounding errors up to ±0.05%. The amounts must be on corresponding sides (withdrawal with debit, deposit with credit).
+- Narration Similarity: Transactions with at least 70% text similarity should be considered potential matches.
+- Reference Numbers: Ignore reference numbers, UTR/RRN numbers, cheque numbers and transaction ids when comparing narrations. They are formatted differently in the bank and the books and are not reliable.
+- Narrations: Compare the meaningful words: counterparty names, purpose (salary, rent, GST, EMI, refund), and payment channel (UPI, NEFT, RTGS, IMPS, ATM, POS, cheque). Ignore case, punctuation, extra spaces and bank-added prefixes such as "UPI/", "NEFT-", "IMPS/P2A/" or "ACH D-". Common abbreviations are equivalent: "PVT"/"private", "LTD"/"limited", "SAL"/"salary", "CHQ"/"cheque", "TRF"/"transfer", "PMT"/"payment".
+- One to one: Each bank transaction can be matched with at most one book transaction and each book transaction with at most one bank transaction. If several candidates qualify, choose the one closest in amount, then in date, then in narration.
+- Never match a transaction with itself, and never invent transactions that are not in the input.
+
+## Classification Rules
+
+- Green (Exact Match): Matches on date (within allowed range), amount, and narration.
+- Yellow (Possible Match): Minor differences in amount or narration but still likely the same transaction. Typical yellow cases: the amount differs by a bank charge or a small fee, the narration names the same counterparty in a different way, or a transaction was split or merged but the date and counterparty agree. Only use yellow when a human reviewer would likely accept the match.
+- Red (Unmatched): No suitable match found. Every bank or book transaction that is not part of a green or yellow pair must be listed in red.
+
+## Examples
+
+- Green: bank ["03/01/24", "NEFT-ACME SUPPLIES PVT LTD-INV 2231", 15000.0, 0.0] and book ["2024-01-01", "Acme Supplies invoice 2231", 15000.0, 0.0]: two days apart, same amount, same counterparty.
+- Yellow: bank ["10/01/24", "UPI/RAJ TRADERS/PAYMENT", 5008.5, 0.0] and book ["2024-01-09", "Raj Traders", 5000.0, 0.0]: same counterparty and date, the difference is a bank charge.
+- Red: bank ["15/01/24", "ATM WDL MUMBAI 0042", 2000.0, 0.0] with no book entry of about 2000.0 within five days. Do not pair it with an unrelated 2000.0 payment three weeks later.
+
+## Output
+
+Return results in valid JSON format with "green", "yellow", and "red" categories:
+{"green": [{"bank": bank_row, "book": book_row}, ...], "yellow": [...], "red": {"bank": [bank_row, ...], "book": [book_row, ...]}}
+- Each green and yellow entry must be an object with the matched bank row under "bank" and the book row under "book".
+- Red holds the unmatched rows, split into the bank rows and the book rows.
+- Copy rows exactly as they were given: the same array of values in the same order and formatting. Do not add, drop or reformat values, do not turn rows into objects, and do not add explanations or comments.
+- Ensure no transactions are skipped: every input transaction appears exactly once in the output, either inside a green or yellow pair or in red.
+- Output only the JSON object, without markdown code fences.
+
+Apply exactly the same decision logic and formatting to every request, so equivalent transactions are always classified the same way.
+"""
+
+
+# Appended to the prompt when a chunk is retried because its response was not valid JSON
+_JSON_REMINDER = (
+    "\nYour previous answer for these transactions was not valid JSON. Reply with exactly one "
+    "complete JSON object in the output format above and nothing else.\n"
+)
+
+
+def _cache_key(request: Dict) -> str:
+    """Response cache key of a chat completion request (see _chat_request)."""
+    return hashlib.blake2b(orjson.dumps(request)).hexdigest()
+
+
+def cached_response(func):
+    """Serves OpenAI responses from the disk cache, keyed by a hash of the full request.
+
+    The model, sampling parameters and response schema are part of the key, so changing
+    them doesn't serve answers in an old layout. A strict retry shares the key of the
+    request it retries, and replaces its answer.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, prompt, *args, **kwargs):
+        key = _cache_key(self._chat_request(prompt))
+        cached = await asyncio.to_thread(_response_cache.get, key)
+        if cached is not None:
+            print(f"Using cached AI response {key[:12]}")
+            return cached
+
+        response = await func(self, prompt, *args, **kwargs)
+        if response:
+            await asyncio.to_thread(_response_cache.set, key, response, expire=RESPONSE_CACHE_EXPIRE)
+        return response
+    return wrapper
+
+
+def _dumps(obj) -> str:
+    """Compact JSON for prompts."""
+    return dumps(obj).decode("utf-8")
+
+
+def _to_table(rows: List[Dict], columns: List[str]) -> Dict:
+    """Tabular prompt layout: column names once, then one array of values per row."""
+    return {"cols": TABLE_COLUMNS, "rows": [[row.get(col) for col in columns] for row in rows]}
+
+
+def _key_value(value):
+    """Normalizes a value the way it round-trips through the AI's JSON."""
+    if isinstance(value, date):  # Also datetimes and pd.Timestamp; the pyarrow CSV engine gives plain dates
+        return value.isoformat()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _txn_key(txn):
+    """Hashable key of a transaction, equal for a row and the AI's JSON echo of it.
+
+    Flat transactions become a sorted tuple of items; anything with unhashable
+    (nested) values falls back to its pickled bytes.
+    """
+    try:
+        if isinstance(txn, dict):
+            key = tuple(sorted((k, _key_value(v)) for k, v in txn.items()))
+        else:
+            key = _key_value(txn)
+        hash(key)
+        return key
+    except TypeError:
+        return pickle.dumps(txn, protocol=5)
+
+
+def _index_rows(positions: Dict, rows: List[Dict], idx):
+    """Records the table row number of each transaction, by _txn_key."""
+    for row, i in zip(rows, idx):
+        positions.setdefault(_txn_key(row), []).append(int(i))
+
+
+# One client, and so one keep-alive connection pool, shared by every request. The
+# semaphore is shared too, so concurrent uploads together stay under the rate limit.
+_client: Optional[openai.AsyncOpenAI] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _openai_client() -> openai.AsyncOpenAI:
+    """Returns the shared OpenAI client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = openai.AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+            ),
+            max_retries=0  # Retries and rate-limit backoff are handled in call_openai_with_retry
+        )
+    return _client
+
+
+def _request_slots() -> asyncio.Semaphore:
+    """Returns the semaphore bounding concurrent OpenAI requests, over all uploads."""
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _semaphore
+
+
+async def close_client():
+    """Closes the shared OpenAI client. Called when the server shuts down."""
+    global _client, _semaphore
+    if _client is not None:
+        await _client.close()
+        _client = None
+    _semaphore = None
+
+
 class AIReconciliationService:
     def __init__(self):
-        openai.api_key = os.getenv('OPENAI_API_KEY')
+        self.failed_chunks = 0  # Chunks of the last run that fell back to red because the AI failed
 
-    def load_and_extract_columns(self, file_path: str, required_columns: List[str]) -> List[Dict]:
+    def load_and_extract_columns(self, file_path: str, required_columns: List[str]) -> Dict[str, np.ndarray]:
         """Loads an Excel file and extracts only the required columns."""
         try:
             df = pd.read_excel(file_path, usecols=required_columns, dtype=str)  # Read specific columns
             df.fillna("", inplace=True)  # Handle NaN values by replacing with an empty string
-            return df.to_dict(orient="records")  # Convert DataFrame to list of dictionaries
+            return {col: df[col].to_numpy() for col in df.columns}  # One numpy array per column
         except Exception as e:
             print(f"Error reading {file_path}: {e}")
-            return []
+            return {}
 
-    def chunk_data(self, data: List[Dict], chunk_size: int = 50) -> List[List[Dict]]:
-        """Splits data into smaller chunks."""
-        return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    async def match_transactions(self, bank_data: Dict[str, np.ndarray], book_data: Dict[str, np.ndarray]) -> Dict:
+        """Matches transactions with the rule-based matcher, then asks the AI about whatever is left.
 
-    async def match_transactions(self, bank_data: List[Dict], book_data: List[Dict]) -> List[Dict]:
-        """Processes transactions sequentially to avoid rate limit issues."""
-        
+        bank_data and book_data are column-oriented: one numpy array per column. The
+        CPU-bound steps run in a worker thread, so other requests keep being served.
+        """
+        matched, chunks, positions = await asyncio.to_thread(self._rule_based_pass, bank_data, book_data)
+
+        # All chunks share one connection pool and run concurrently
+        chunk_results = await asyncio.gather(
+            *(self.process_chunk(bank_chunk, book_chunk + neighbor_chunk, index)
+              for index, (bank_chunk, book_chunk, neighbor_chunk) in enumerate(chunks))
+        )
+
+        return await asyncio.to_thread(self._finish, matched, chunks, chunk_results, positions, uuid.uuid4().hex)
+
+    async def match_transactions_batch(self, bank_data: Dict[str, np.ndarray], book_data: Dict[str, np.ndarray]) -> Dict:
+        """Like match_transactions, but sends the AI chunks through the Batch API.
+
+        Returns {"batch_id": ...} to poll with fetch_batch_results, or the final results
+        straight away if the rule-based matcher left nothing for the AI.
+        """
+        matched, chunks, positions = await asyncio.to_thread(self._rule_based_pass, bank_data, book_data)
+        if not chunks:
+            return await asyncio.to_thread(self._finish, matched, chunks, [], positions, uuid.uuid4().hex)
+
+        batch_id = await self.submit_batch([
+            self._create_matching_prompt(bank_chunk, book_chunk + neighbor_chunk)
+            for bank_chunk, book_chunk, neighbor_chunk in chunks
+        ])
+        await asyncio.to_thread(_batch_jobs.set, batch_id, {"matched": matched, "chunks": chunks, "positions": positions},
+                                expire=2 * 86400)
+        return {"batch_id": batch_id}
+
+    def _rule_based_pass(self, bank_data: Dict[str, np.ndarray], book_data: Dict[str, np.ndarray]) -> Tuple[Dict, List[Tuple[List[Dict], List[Dict], List[Dict]]], Tuple[Dict, Dict]]:
+        """Runs the rule-based matcher. Returns its results, the chunks left for the AI and
+        the bank and book row numbers of every transaction (by _txn_key).
+
+        Rows are only materialized as dicts here, for the output and the AI prompts.
+        """
+        book_idx, category, score = matcher.match(bank_data, book_data, BANK_COLUMNS, BOOK_COLUMNS)
+
+        matched = {"green": [], "yellow": [], "red": []}
+        bank_positions, book_positions = {}, {}
+        bank_rows = np.flatnonzero(book_idx >= 0)
+        matched_bank = matcher.to_rows(bank_data, bank_rows)
+        matched_book = matcher.to_rows(book_data, book_idx[bank_rows])
+        _index_rows(bank_positions, matched_bank, bank_rows)
+        _index_rows(book_positions, matched_book, book_idx[bank_rows])
+        for bank_row, book_row, i in zip(matched_bank, matched_book, bank_rows):
+            label = "green" if category[i] == matcher.GREEN else "yellow"
+            matched[label].append({"bank": bank_row, "book": book_row, "score": round(float(score[i]), 2)})
+
+        # Only transactions the rules could not place are sent to the AI
+        book_matched = np.zeros(matcher.num_rows(book_data), dtype=bool)
+        book_matched[book_idx[bank_rows]] = True
+        unmatched_bank = np.flatnonzero(book_idx < 0)
+        unmatched_book = np.flatnonzero(~book_matched)
+        print(f"Rule-based matching placed {len(matched['green']) + len(matched['yellow'])} transactions, "
+              f"{len(unmatched_bank) + len(unmatched_book)} left for AI")
+
+        # Chunks hold transactions that are close in date, so candidates land in the same prompt
         chunk_size = 50  # Adjust chunk size to balance efficiency and API limits
+        blocks = matcher.date_blocks(bank_data, book_data, unmatched_bank, unmatched_book,
+                                     BANK_COLUMNS, BOOK_COLUMNS, chunk_size)
+        chunks = []
+        for bank_block, book_block, neighbor_block in blocks:
+            bank_chunk = matcher.to_rows(bank_data, bank_block)
+            book_chunk = matcher.to_rows(book_data, book_block)
+            _index_rows(bank_positions, bank_chunk, bank_block)
+            _index_rows(book_positions, book_chunk, book_block)
+            if not bank_chunk or not (len(book_block) or len(neighbor_block)):
+                # Nothing to match against within the date window
+                matched["red"].extend(bank_chunk + book_chunk)
+                continue
+            chunks.append((bank_chunk, book_chunk, matcher.to_rows(book_data, neighbor_block)))
+        return matched, chunks, (bank_positions, book_positions)
+
+    def _finish(self, matched: Dict, chunks, chunk_results, positions, job_id: str) -> Dict:
+        """Combines the rule-based results with the AI's answers for the chunks. The
+        results name the `job_id` their records are saved under (see _save_results)."""
+        results = self._combine_results([matched] + self._with_fallback(chunks, chunk_results, matched["red"]), positions, job_id)
+        results["job_id"] = job_id
+        return results
+
+    def _with_fallback(self, chunks, chunk_results, unplaced: List[Dict]) -> List[Dict]:
+        """Restores deduplicated transactions in the AI results, and keeps the transactions
+        as unmatched if the AI could not process their chunk.
+
+        Neighboring book rows are only reported as unmatched by the chunk that owns them,
+        and only matched as often as they occur (see _one_to_one). `unplaced` are the
+        rows that went straight to red without a chunk.
+        """
         results = []
-        unmatched_bank = []
-        unmatched_book = []
-
-        # **First Pass: Process chunks one by one**
-        for i in range(0, max(len(bank_data), len(book_data)), chunk_size):
-            bank_chunk = bank_data[i:i + chunk_size]
-            book_chunk = book_data[i:i + chunk_size]
-            
-            result = await self.process_chunk(bank_chunk, book_chunk, i // chunk_size)
-            
-            if result:
-                results.append(result)
-                unmatched_bank.extend(result.get("red", []))
-                unmatched_book.extend(result.get("red", []))
-
-            # **Introduce a delay to avoid rate limits**
-            await asyncio.sleep(2)
-
-        # **Second Pass: Process remaining unmatched transactions**
-        if unmatched_bank and unmatched_book:
-            print(f"Processing final batch of {len(unmatched_bank)} unmatched transactions...")
-            final_result = await self.process_chunk(unmatched_bank, unmatched_book, "final")
-            
-            if final_result:
-                results.append(final_result)
-
-        return self._combine_results(results)
+        self.failed_chunks = 0
+        for (bank_chunk, book_chunk, neighbor_chunk), result in zip(chunks, chunk_results):
+            if result is None:
+                self.failed_chunks += 1
+                results.append({"red": bank_chunk + book_chunk})
+                continue
+            result = self._expand_duplicates(result, bank_chunk, book_chunk + neighbor_chunk)
+            neighbors = {_txn_key(txn) for txn in neighbor_chunk} - {_txn_key(txn) for txn in book_chunk}
+            result["red"] = [txn for txn in result.get("red", []) if _txn_key(txn) not in neighbors]
+            results.append(result)
+        self._one_to_one(results, chunks, unplaced)
+        return results
+
+    def _one_to_one(self, results: List[Dict], chunks, unplaced: List[Dict]):
+        """Keeps each book row in at most as many pairs as it has copies.
+
+        A neighbor is sent to several chunks, and each of them may match it. Green beats
+        yellow, then the chunk that owns the row wins; the losing bank rows go to red.
+        """
+        copies = {}
+        for txn in [row for _, book_chunk, _ in chunks for row in book_chunk] + unplaced:
+            key = _txn_key(txn)
+            copies[key] = copies.get(key, 0) + 1
+
+        candidates = []
+        for n, (result, (_, book_chunk, _)) in enumerate(zip(results, chunks)):
+            own = {_txn_key(txn) for txn in book_chunk}
+            for label in ("green", "yellow"):
+                for i, pair in enumerate(result.get(label, [])):
+                    key = _txn_key(pair["book"])
+                    candidates.append((label == "yellow", key not in own, n, label, i, key))
+        candidates.sort(key=lambda candidate: candidate[:2])
+
+        used, losers = {}, set()
+        for _, _, n, label, i, key in candidates:
+            if used.get(key, 0) < copies.get(key, 0):
+                used[key] = used.get(key, 0) + 1
+            else:
+                losers.add((n, label, i))
+        if not losers:
+            return
+
+        print(f"Dropped {len(losers)} AI matches of book rows that were already matched in another chunk")
+        for n, result in enumerate(results):
+            for label in ("green", "yellow"):
+                pairs = result.get(label, [])
+                result[label] = [pair for i, pair in enumerate(pairs) if (n, label, i) not in losers]
+                result["red"] = result.get("red", []) + [pair["bank"] for i, pair in enumerate(pairs) if (n, label, i) in losers]
+
+    async def submit_batch(self, prompts: List[str]) -> str:
+        """Uploads one chat completion request per prompt as a JSONL file and starts a batch."""
+        lines = [
+            orjson.dumps({"custom_id": str(index), "method": "POST", "url": "/v1/chat/completions",
+                          "body": self._chat_request(prompt)})
+            for index, prompt in enumerate(prompts)
+        ]
+        client = _openai_client()
+        batch_file = await client.files.create(
+            file=("reconciliation.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=BATCH_COMPLETION_WINDOW
+        )
+        print(f"Submitted batch {batch.id} with {len(prompts)} chunks")
+        return batch.id
+
+    async def fetch_batch_results(self, batch_id: str) -> Optional[Dict]:
+        """Returns the combined results of a finished batch, {"status": ...} while it is
+        still running, or None for an unknown batch.
+
+        A batch that ended failed, expired or cancelled still returns the chunks that
+        finished; the rest are red, and the results carry "batch_status" and
+        "failed_chunks" so they can't be taken for a complete reconciliation.
+        """
+        job = await asyncio.to_thread(_batch_jobs.get, batch_id)
+        if job is None:
+            return None
+
+        client = _openai_client()
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status != "completed" and batch.status not in BATCH_FAILED_STATUSES:
+            return {"batch_id": batch_id, "status": batch.status}
+
+        chunk_results = [None] * len(job["chunks"])
+        if batch.status != "completed":
+            print(f"Batch {batch_id} ended with status {batch.status}")
+        # An expired or cancelled batch still has the output of the requests that finished
+        if batch.output_file_id:
+            output = await client.files.content(batch.output_file_id)
+            for line in output.content.splitlines():
+                entry = orjson.loads(line)
+                response = entry.get("response") or {}
+                if response.get("status_code") != 200:
+                    print(f"Batch request {entry.get('custom_id')} failed: {entry.get('error')}")
+                    continue
+                index = int(entry["custom_id"])
+                self._log_usage(response["body"].get("usage") or {})
+                message = response["body"]["choices"][0]["message"]
+                raw_response = message.get("content")
+                if not raw_response or message.get("refusal"):
+                    # Strict structured outputs answer a refusal with no content
+                    print(f"Batch request {index} returned no answer: {message.get('refusal')}")
+                    continue
+                result = self._parse_response(raw_response, index)
+                if result is not None:
+                    bank_chunk, book_chunk, neighbor_chunk = job["chunks"][index]
+                    result = self._from_table(result, bank_chunk, book_chunk + neighbor_chunk)
+                chunk_results[index] = result
+
+        results = await asyncio.to_thread(self._finish, job["matched"], job["chunks"], chunk_results, job.get("positions"), batch_id)
+        if batch.status != "completed" or self.failed_chunks:
+            results.update(batch_status=batch.status, failed_chunks=self.failed_chunks)
+        return results
 
     async def process_chunk(self, bank_chunk: List[Dict], book_chunk: List[Dict], index):
-        """Processes a single chunk asynchronously."""
+        """Processes a single chunk asynchronously. Returns the AI's answer mapped back to
+        the chunk's transactions (see _from_table), or None if the AI failed.
+
+        If the response is not valid JSON, even after repair, or doesn't follow the
+        tabular layout, it is evicted from the response cache and the chunk is asked once
+        more with a stricter request.
+        """
         prompt = self._create_matching_prompt(bank_chunk, book_chunk)
 
-        response = await self.call_openai_with_retry(prompt)
-        if response:
-            try:
-                raw_response = response.choices[0].message['content'].strip()
-                print(f"Raw AI Response for chunk {index}: {raw_response}")  # Debugging print
-                return json.loads(raw_response)
-            except Exception as e:
-                print(f"Error parsing JSON for chunk {index}: {str(e)}")
+        for strict in (False, True):
+            raw_response = await self.call_openai_with_retry(prompt, strict=strict)
+            if not raw_response:
+                return None
+
+            result = self._parse_response(raw_response, index)
+            if result is not None:
+                result = self._from_table(result, bank_chunk, book_chunk)
+            if result is not None:
+                return result
+
+            key = _cache_key(self._chat_request(prompt))
+            await asyncio.to_thread(_response_cache.delete, key)
+            print(f"Discarded invalid AI response {key[:12]} for chunk {index}")
         return None
 
-    async def call_openai_with_retry(self, prompt, retries=1):
-        """Calls OpenAI API with a single retry mechanism."""
-        for attempt in range(retries + 1):
+    def _parse_response(self, raw_response: str, index):
+        """Parses the JSON returned by the AI for a chunk. Structured outputs make it valid
+        JSON, except when the response is cut off at max_tokens; that is repaired."""
+        raw_response = raw_response.strip()
+        print(f"Raw AI Response for chunk {index}: {raw_response}")  # Debugging print
+        try:
+            return orjson.loads(raw_response)
+        except orjson.JSONDecodeError as e:
+            print(f"Error parsing JSON for chunk {index}: {str(e)}, trying to repair it")
+
+        try:
+            repaired = json_repair.repair_json(raw_response, return_objects=True)
+        except Exception as e:
+            print(f"Could not repair JSON for chunk {index}: {str(e)}")
+            return None
+        if not isinstance(repaired, dict) or not repaired.keys() & {"green", "yellow", "red"}:
+            print(f"Could not repair JSON for chunk {index}")
+            return None
+        return repaired
+
+    @cached_response
+    async def call_openai_with_retry(self, prompt, retries=1, strict: bool = False):
+        """Calls OpenAI API with a single retry, backing off exponentially on rate limits.
+
+        The completion is requested in one piece: a chunk's answer is only used once it
+        is complete (it is parsed, mapped and checked as a whole), so streaming it
+        wouldn't make any result available sooner. `strict` asks again for a chunk
+        whose response was not valid JSON. Returns the response text, or None if the
+        model refused.
+        """
+        attempt, rate_limited = 0, 0
+        while True:
             try:
-                response = await openai.ChatCompletion.acreate(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": self._get_system_prompt()},
-                        {"role": "user", "content": prompt}
-                    ],
-                    response_format={"type": "json_object"},
-                    temperature=0.2,
-                    max_tokens=8000
-                )
-                return response
+                async with _request_slots():
+                    response = await _openai_client().chat.completions.create(**self._chat_request(prompt, strict=strict))
+                if response.usage:
+                    self._log_usage(response.usage.model_dump())
+                message = response.choices[0].message
+                if getattr(message, "refusal", None):
+                    print(f"OpenAI refused the request: {message.refusal}")
+                    return None
+                return message.content
+            except openai.RateLimitError as e:
+                if rate_limited == RATE_LIMIT_RETRIES:
+                    print(f"Final failure for OpenAI API: {e}")
+                    return None
+                delay = 2 ** rate_limited + random.random()
+                rate_limited += 1
+                print(f"Rate limited, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
             except Exception as e:
                 if attempt == retries:
                     print(f"Final failure for OpenAI API: {e}")
                     return None
+                attempt += 1
                 print(f"Retrying due to API error: {e}")
                 await asyncio.sleep(1)
 
+    def _log_usage(self, usage: Dict):
+        """Logs how much of the prompt was served from OpenAI's prompt cache."""
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        print(f"Prompt tokens: {usage.get('prompt_tokens', 0)} (cached: {cached})")
+
+    def _chat_request(self, prompt: str, strict: bool = False) -> Dict:
+        """Builds the chat completion parameters for a matching prompt.
+
+        `strict` is deterministic and repeats the JSON instruction, for retrying
+        responses that could not be parsed.
+        """
+        return {
+            "model": "gpt-4o",
+            "messages": [
+                {"role": "system", "content": self._get_system_prompt()},
+                {"role": "user", "content": prompt + _JSON_REMINDER if strict else prompt}
+            ],
+            "response_format": {
+                "type": "json_schema",
+                "json_schema": {"name": "recon", "strict": True, "schema": MATCH_SCHEMA}
+            },
+            "temperature": 0 if strict else 0.2,
+            "max_tokens": 8000
+        }
+
     def _get_system_prompt(self) -> str:
         """Returns the system prompt for AI model"""
-        return """
-            You are an expert in financial reconciliation handling large datasets mostly CSV.
-            Your goal is to match bank transactions with book records based on:
-            
-            - Date Matching: Transactions can be matched with up to a 5-day difference.
-            - Amount Matching: Accept minor rounding errors up to ±0.05%.
-            - Narration Similarity: Transactions with at least 70% text similarity should be considered potential matches.
-            
-            Classification Rules:
-            - Green (Exact Match): Matches on date (within allowed range), amount, and narration.
-            - Yellow (Possible Match): Minor differences in amount or narration but still likely the same transaction.
-            - Red (Unmatched): No suitable match found.
-
-            Return results in valid JSON format with "green", "yellow", and "red" categories.
-            Use the same decision logic and formatting as previous chunks.
-            For each transaction, if a similar one was found in previous chunks, ensure it is matched consistently.
-        """
+        return _SYSTEM_PROMPT
 
     def _create_matching_prompt(self, bank_data: List[Dict], book_data: List[Dict]) -> str:
-        """Convert transactions into a structured AI prompt while handling datetime serialization."""
-        
-        def convert_datetime(obj):
-            """Convert datetime objects to string format (ISO 8601)."""
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            return obj
-            
+        """Convert transactions into a structured AI prompt.
+
+        Identical transactions are sent once, with a count of how many times they occur.
+        """
+        unique_bank, bank_counts = self._dedupe(bank_data)
+        unique_book, book_counts = self._dedupe(book_data)
+
         prompt = (
             f"Here are two sets of transactions:\n\n"
-            f"Bank Transactions:\n{json.dumps(bank_data, separators=(',', ':'), default=convert_datetime)}\n\n"
-            f"Book Transactions:\n{json.dumps(book_data, separators=(',', ':'), default=convert_datetime)}\n\n"
-            "Match transactions based on date, amount, and narration similarity.\n"
-            "Ignore reference numbers when finding matches.\n"
-            "Provide the results in valid JSON format with three categories:\n"
-            "- Green: Exact match.\n"
-            "- Yellow: Possible match.\n"
-            "- Red: No match found.\n"
-            "Ensure no transactions are skipped.\n"
+            f"Bank Transactions:\n{_dumps(_to_table(unique_bank, BANK_COLUMNS))}\n"
+            f"Bank Counts:\n{_dumps(list(bank_counts.values()))}\n\n"
+            f"Book Transactions:\n{_dumps(_to_table(unique_book, BOOK_COLUMNS))}\n"
+            f"Book Counts:\n{_dumps(list(book_counts.values()))}\n\n"
+            "Match these transactions following the rules above.\n"
         )
         
         return prompt
 
-    def _combine_results(self, results: List) -> List[Dict]:
-        """Combine the JSON results from all matches into a single output, ensuring unmatched transactions are properly updated."""
+    def _from_table(self, result: Dict, bank_chunk: List[Dict], book_chunk: List[Dict]) -> Optional[Dict]:
+        """Maps the row arrays of an AI result back to the chunk's transactions, by column
+        position. Returns None if the result doesn't follow the tabular layout.
+
+        Rows that aren't in the chunk (misquoted, or the cut-off last row of a repaired
+        response) are dropped, along with any pair they are in; so are pairs a repaired
+        response cut off before their second row.
+        """
+        def lookup(chunk, columns):
+            rows = {_txn_key({col: row.get(col) for col in columns}): row for row in chunk}
+            return lambda values: rows.get(_txn_key(dict(zip(columns, values)))) if isinstance(values, list) else None
+
+        bank, book = lookup(bank_chunk, BANK_COLUMNS), lookup(book_chunk, BOOK_COLUMNS)
+        try:
+            red = result.get("red") or {}
+            converted = {
+                label: [{"bank": bank(pair.get("bank")), "book": book(pair.get("book"))} for pair in result.get(label, [])]
+                for label in ("green", "yellow")
+            }
+            converted["red"] = [bank(values) for values in red.get("bank", [])] + [book(values) for values in red.get("book", [])]
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"Error reading AI result: {e}")
+            return None
+
+        unknown = sum(txn is None for txn in converted["red"])
+        converted["red"] = [txn for txn in converted["red"] if txn is not None]
+        for label in ("green", "yellow"):
+            pairs = converted[label]
+            converted[label] = [pair for pair in pairs if pair["bank"] is not None and pair["book"] is not None]
+            unknown += len(pairs) - len(converted[label])
+        if unknown:
+            print(f"Ignored {unknown} AI entries that don't match a transaction of the chunk")
+
+        # A truncated (repaired) response can leave transactions out; they stay unmatched
+        reported = {_txn_key(txn) for txn in converted["red"]}
+        reported.update(_txn_key(txn) for pair in converted["green"] + converted["yellow"] for txn in pair.values())
+        missing = [row for row in self._dedupe(bank_chunk)[0] + self._dedupe(book_chunk)[0] if _txn_key(row) not in reported]
+        if missing:
+            print(f"AI result left out {len(missing)} transactions, keeping them unmatched")
+            converted["red"].extend(missing)
+        return converted
+
+    def _dedupe(self, rows: List[Dict]) -> Tuple[List[Dict], Dict[str, int]]:
+        """Returns the distinct rows, in first-seen order, and how often each occurs (by key)."""
+        unique, counts = [], {}
+        for row in rows:
+            key = _txn_key(row)
+            if key not in counts:
+                unique.append(row)
+                counts[key] = 0
+            counts[key] += 1
+        return unique, counts
+
+    def _expand_duplicates(self, result: Dict, bank_chunk: List[Dict], book_chunk: List[Dict]) -> Dict:
+        """Repeats the AI's answer for deduplicated transactions as many times as they
+        occurred, and no more: pairs beyond a row's copies are dropped, on either side."""
+        unique_bank, bank_counts = self._dedupe(bank_chunk)
+        unique_book, book_counts = self._dedupe(book_chunk)
+        remaining = {**bank_counts, **book_counts}
+        rows = {_txn_key(row): row for row in unique_bank + unique_book}
+        expanded = {"green": [], "yellow": [], "red": []}
+        paired = set()
+
+        # A matched pair repeats as often as both sides have copies left
+        for label in ("green", "yellow"):
+            for pair in result.get(label, []):
+                keys = [_txn_key(pair.get(side)) for side in ("bank", "book")]
+                copies = min(remaining.get(key, 0) for key in keys)
+                expanded[label].extend([pair] * copies)
+                for key in keys:
+                    if key in remaining:
+                        remaining[key] -= copies
+                        paired.add(key)
+
+        for txn in result.get("red", []):
+            key = _txn_key(txn)
+            expanded["red"].extend([txn] * remaining.pop(key, 1))
+
+        # Copies left over on one side of a matched (or dropped) pair are unmatched
+        for key, count in remaining.items():
+            if key in paired:
+                expanded["red"].extend([rows[key]] * count)
+        return expanded
+
+    def _combine_results(self, results: List, positions: Optional[Tuple[Dict, Dict]] = None, job_id: Optional[str] = None) -> Dict:
+        """Combine the JSON results from all matches into a single output, ensuring unmatched transactions are properly updated.
+
+        With the row numbers from _rule_based_pass, the output is also filled into
+        RESULT_DTYPE records as it is combined, and saved under `job_id` (see
+        _save_results). Copies of a transaction are given distinct row numbers, in order.
+        """
         combined_results = {"green": [], "yellow": [], "red": []}
-        unmatched_set = set()  # Track transactions that were initially unmatched
+        unmatched = []  # Initially unmatched transactions of each result, with their number of copies
+        originals = {}  # The transaction of each key, as it was given, for the output
+        matched_counts = {}  # How often each transaction was matched, over all results
+
+        results = [orjson.loads(result) if isinstance(result, str) else result for result in results]
+
+        # Sized for every entry, before red transactions matched elsewhere are dropped
+        capacity = sum(len(result.get(label, [])) for result in results for label in combined_results)
+        records = np.empty(capacity if positions is not None else 0, dtype=RESULT_DTYPE)
+        bank_positions, book_positions = positions or ({}, {})
+        bank_left = {key: iter(rows) for key, rows in bank_positions.items()}
+        book_left = {key: iter(rows) for key, rows in book_positions.items()}
+        filled = 0
 
         for result in results:
             try:
-                if isinstance(result, str):
-                    result = json.loads(result)
-
                 combined_results["green"].extend(result.get("green", []))
                 combined_results["yellow"].extend(result.get("yellow", []))
-                
+
+                own_matches = {}
+                for label, category in (("green", matcher.GREEN), ("yellow", matcher.YELLOW)):
+                    for pair in result.get(label, []):
+                        bank_key, book_key = _txn_key(pair.get("bank")), _txn_key(pair.get("book"))
+                        for key in (bank_key, book_key):
+                            own_matches[key] = own_matches.get(key, 0) + 1
+                            matched_counts[key] = matched_counts.get(key, 0) + 1
+                        if positions is not None:
+                            records[filled] = (next(bank_left.get(bank_key, iter(())), -1),
+                                               next(book_left.get(book_key, iter(())), -1), category, pair.get("score", np.nan))
+                            filled += 1
+
                 # Track initially unmatched transactions
+                red_counts = {}
                 for txn in result.get("red", []):
-                    unmatched_set.add(json.dumps(txn, sort_keys=True))  # Store as string to handle dict comparisons
+                    key = _txn_key(txn)  # Store as a hashable key to handle dict comparisons
+                    originals.setdefault(key, txn)
+                    red_counts[key] = red_counts.get(key, 0) + 1
+                unmatched.append((red_counts, own_matches))
 
             except Exception as e:
                 print(f"Error processing result: {str(e)}")
 
-        # **Remove transactions from "red" if they got matched later**
-        matched_set = {
-            json.dumps(txn, sort_keys=True)
-            for txn in (combined_results["green"] + combined_results["yellow"])
-        }
-
-        combined_results["red"] = [
-            json.loads(txn) for txn in unmatched_set if txn not in matched_set
-        ]
+        # **Remove transactions from "red" if they got matched in another result** (one copy per match)
+        for red_counts, own_matches in unmatched:
+            for txn, count in red_counts.items():
+                matched_elsewhere = matched_counts.get(txn, 0) - own_matches.get(txn, 0)
+                copies = count - matched_elsewhere
+                combined_results["red"].extend(originals[txn] for _ in range(copies))
+                for _ in range(copies if positions is not None else 0):
+                    # A red transaction is on the book side if it isn't a bank row
+                    bank_idx = next(bank_left.get(txn, iter(())), -1)
+                    book_idx = next(book_left.get(txn, iter(())), -1) if bank_idx < 0 else -1
+                    records[filled] = (bank_idx, book_idx, matcher.RED, np.nan)
+                    filled += 1
 
         # **Logging for Debugging**
         print(f"Total Transactions Processed: {sum(map(len, combined_results.values()))}")
         print(f"Green: {len(combined_results['green'])}, Yellow: {len(combined_results['yellow'])}, Red: {len(combined_results['red'])}")
 
-        # Save to JSON for debugging
-        with open("ai_results.json", "w", encoding="utf-8") as file:
-            json.dump(combined_results, file, indent=4)
+        if positions is not None:
+            self._save_results(records[:filled], job_id or uuid.uuid4().hex)
 
         return combined_results
 
+    def _save_results(self, records: np.ndarray, job_id: str):
+        """Writes the records to RESULTS_FOLDER/<job_id>.parquet, plus a small JSON summary.
+
+        Every job has its own files, so concurrent uploads and batch polls don't overwrite
+        each other's results. Files older than RESULTS_EXPIRE are deleted first.
+        """
+        try:
+            os.makedirs(RESULTS_FOLDER, exist_ok=True)
+            self._prune_results()
+            path = os.path.join(RESULTS_FOLDER, f"{job_id}.parquet")
+            table = pa.Table.from_arrays([pa.array(records[name]) for name in RESULT_DTYPE.names], names=list(RESULT_DTYPE.names))
+            pq.write_table(table, path, compression="zstd")
+
+            counts = np.bincount(records["category"], minlength=3)
+            summary = {"job_id": job_id, "total": len(records), "green": counts[matcher.GREEN], "yellow": counts[matcher.YELLOW],
+                       "red": counts[matcher.RED], "results": path}
+            with open(os.path.join(RESULTS_FOLDER, f"{job_id}.json"), "wb") as file:
+                file.write(dumps(summary, option=orjson.OPT_INDENT_2))
+            print(f"Saved results to {path}")
+        except Exception as e:
+            print(f"Could not save results: {str(e)}")
+
+    def _prune_results(self):
+        """Deletes saved results older than RESULTS_EXPIRE."""
+        cutoff = time.time() - RESULTS_EXPIRE
+        with os.scandir(RESULTS_FOLDER) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass  # Already deleted by a concurrent job
+
 
 
 # **Usage Example**
 if __name__ == "__main__":
     reconciliation_service = AIReconciliationService()
 
-    bank_columns = ['Date', 'Narration', 'Withdrawal Amt.', 'Deposit Amt.']
-    book_columns = ['date', 'transaction_details', 'debit', 'credit']
-
-    bank_data = reconciliation_service.load_and_extract_columns("bank_statement.xlsx", bank_columns)
-    book_data = reconciliation_service.load_and_extract_columns("company_records.xlsx", book_columns)
-
-    bank_chunks = reconciliation_service.chunk_data(bank_data)
-    book_chunks = reconciliation_service.chunk_data(book_data)
+    bank_data = reconciliation_service.load_and_extract_columns("bank_statement.xlsx", BANK_COLUMNS)
+    book_data = reconciliation_service.load_and_extract_columns("company_records.xlsx", BOOK_COLUMNS)
 
     asyncio.run(reconciliation_service.match_transactions(bank_data, book_data))
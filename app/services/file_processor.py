@@ -1,6 +1,19 @@
+import asyncio
+import hashlib
+import io
+import os
 from typing import Dict, List
 import pandas as pd
-from .ai_service import AIReconciliationService  # Import the AIReconciliationService
+from diskcache import Cache
+from config import Config
+from .ai_service import AIReconciliationService, BANK_COLUMNS, BOOK_COLUMNS
+
+# Parsed uploads are kept as Parquet for a week, keyed by a hash of the file contents;
+# the least recently used ones are evicted beyond 1 GB
+FILE_CACHE_EXPIRE = 7 * 86400
+FILE_CACHE_SIZE_LIMIT = 1 << 30
+_file_cache = Cache(os.path.join(Config.CACHE_FOLDER, 'parsed'), size_limit=FILE_CACHE_SIZE_LIMIT,
+                    eviction_policy='least-recently-used')
 
 class ReconciliationProcessor:
     def __init__(self):
@@ -9,32 +22,60 @@ class ReconciliationProcessor:
     def _read_file(self, file_path: str, required_columns: List[str]) -> pd.DataFrame:
         """Reads an Excel or CSV file and extracts only the required columns."""
         try:
+            content = file_path.read()
+            key = hashlib.blake2b(content + "|".join(required_columns).encode(), digest_size=16).hexdigest()
+            cached = _file_cache.get(key)
+            if cached is not None:
+                return pd.read_parquet(io.BytesIO(cached), engine="pyarrow")
+
+            # Only the required columns that exist in the file are parsed
             if file_path.filename.split(".")[-1] == "csv":
-                df = pd.read_csv(file_path)
+                # The pyarrow engine doesn't take a callable usecols, so check the header first
+                header = pd.read_csv(io.BytesIO(content), nrows=0).columns
+                available_columns = [col for col in required_columns if col in header]
+                # usecols=[] would make the pyarrow engine parse every column
+                if not available_columns:
+                    raise ValueError(f"none of the columns {required_columns} found")
+                df = pd.read_csv(io.BytesIO(content), engine="pyarrow", usecols=available_columns)
             else:
-                df = pd.read_excel(file_path)
-
-            # Select only the required columns if they exist
-            available_columns = [col for col in required_columns if col in df.columns]
-            df = df[available_columns]
+                df = pd.read_excel(io.BytesIO(content), engine="calamine", usecols=lambda col: col in required_columns)
+                if df.columns.empty:
+                    raise ValueError(f"none of the columns {required_columns} found")
 
+            self._cache_file(df, key)
             return df
         except Exception as e:
             raise Exception(f"Error reading file {file_path}: {str(e)}")
 
-    async def process_files_with_ai(self, bank_file, book_file) -> Dict:
-        # Define relevant columns for bank and book data
-        bank_columns = ['Date', 'Narration', 'Withdrawal Amt.', 'Deposit Amt.']
-        book_columns = ['date', 'transaction_details', 'debit', 'credit']
+    def _cache_file(self, df: pd.DataFrame, key: str):
+        """Writes a parsed file to the Parquet cache. Failures only cost the cache entry."""
+        try:
+            content = io.BytesIO()
+            df.to_parquet(content, engine="pyarrow", compression="zstd")
+            _file_cache.set(key, content.getvalue(), expire=FILE_CACHE_EXPIRE)
+        except Exception as e:
+            print(f"Could not cache parsed file: {str(e)}")
 
+    def _load_data(self, bank_file, book_file):
         # Read files and extract required columns
-        bank_df = self._read_file(bank_file, bank_columns)
-        book_df = self._read_file(book_file, book_columns)
+        bank_df = self._read_file(bank_file, BANK_COLUMNS)
+        book_df = self._read_file(book_file, BOOK_COLUMNS)
+
+        # Keep the data column-oriented: one numpy array per column
+        bank_data = {col: bank_df[col].to_numpy() for col in bank_df.columns}
+        book_data = {col: book_df[col].to_numpy() for col in book_df.columns}
+        return bank_data, book_data
 
-        # Convert DataFrames to dictionaries
-        bank_data = bank_df.to_dict(orient='records')
-        book_data = book_df.to_dict(orient='records')
+    async def process_files_with_ai(self, bank_file, book_file) -> Dict:
+        # Parsing is CPU-bound; keep it off the event loop
+        bank_data, book_data = await asyncio.to_thread(self._load_data, bank_file, book_file)
 
         # Use AI service to match transactions
         results = await self.ai_service.match_transactions(bank_data, book_data)
         return results
+
+    async def process_files_with_batch(self, bank_file, book_file) -> Dict:
+        bank_data, book_data = await asyncio.to_thread(self._load_data, bank_file, book_file)
+
+        # Submit the AI part as a batch job; returns {"batch_id": ...} unless nothing was left for the AI
+        return await self.ai_service.match_transactions_batch(bank_data, book_data)
@@ -0,0 +1,331 @@
+import re
+import threading
+from typing import Dict, List, Tuple
+import numba
+import numpy as np
+import pandas as pd
+
+# Matching rules, kept in sync with the system prompt used for the LLM fallback
+DATE_WINDOW_DAYS = 5
+AMOUNT_TOLERANCE = 5e-4  # ±0.05%
+NARRATION_THRESHOLD = 0.7
+MIN_NARRATION_SIMILARITY = 0.3  # An exact amount alone isn't enough for yellow
+MAX_NARRATION_TOKENS = 64
+
+GREEN, YELLOW, RED = 0, 1, 2
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# match() runs in worker threads; Numba's default threading layer can't run parallel
+# kernels from several threads at once, and each call already uses every core
+_kernel_lock = threading.Lock()
+
+
+def num_rows(data: Dict[str, np.ndarray]) -> int:
+    """Number of rows in a column-oriented table (dict of numpy arrays)."""
+    return len(next(iter(data.values()))) if data else 0
+
+
+def to_rows(data: Dict[str, np.ndarray], idx) -> List[Dict]:
+    """Materializes the selected rows of a column-oriented table as row dicts."""
+    idx = np.asarray(idx, dtype=np.int64)
+    return pd.DataFrame({col: values[idx] for col, values in data.items()}).to_dict(orient="records")
+
+
+def _column(data: Dict[str, np.ndarray], col: str) -> np.ndarray:
+    """Returns a column, or an empty (all None) one if the file didn't have it."""
+    if col in data:
+        return data[col]
+    return np.full(num_rows(data), None, dtype=object)
+
+
+def _to_days(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Converts dates to int64 epoch days. Returns the days and a mask of parseable dates."""
+    values = pd.Series(values)
+    # ISO dates first so dayfirst parsing of statement dates (dd/mm/yy) doesn't swap them
+    dates = pd.to_datetime(values, errors="coerce", format="ISO8601")
+    missing = dates.isna()
+    if missing.any():
+        dates = dates.fillna(pd.to_datetime(values[missing], errors="coerce", dayfirst=True))
+    valid = dates.notna().to_numpy()
+    days = dates.to_numpy().astype("datetime64[D]").view("i8")
+    return days, valid
+
+
+def _to_amount(outflow: np.ndarray, inflow: np.ndarray) -> np.ndarray:
+    """Nets the outflow/inflow columns into a single signed float64 amount."""
+    outflow = pd.to_numeric(pd.Series(outflow), errors="coerce").fillna(0.0).to_numpy(np.float64)
+    inflow = pd.to_numeric(pd.Series(inflow), errors="coerce").fillna(0.0).to_numpy(np.float64)
+    return inflow - outflow
+
+
+def _narr_to_ids(narrations: np.ndarray, vocab: Dict[str, int]) -> np.ndarray:
+    """Encodes narrations as a (n_rows, max_tokens) int32 array of sorted, unique token
+    ids, padded with -1. `vocab` is shared by both sides so equal tokens get equal ids."""
+    rows = []
+    for text in narrations:
+        ids = {vocab.setdefault(tok, len(vocab)) for tok in _TOKEN_RE.findall(str(text or "").lower())}
+        rows.append(sorted(ids)[:MAX_NARRATION_TOKENS])
+
+    out = np.full((len(rows), max(1, max(map(len, rows), default=0))), -1, dtype=np.int32)
+    for i, ids in enumerate(rows):
+        out[i, :len(ids)] = ids
+    return out
+
+
+@numba.njit(fastmath=True, cache=True)
+def _jaccard(a, b):
+    """Token-set Jaccard similarity of two sorted, -1 padded token rows."""
+    i = j = common = 0
+    while i < len(a) and a[i] >= 0 and j < len(b) and b[j] >= 0:
+        if a[i] == b[j]:
+            common += 1
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+    while i < len(a) and a[i] >= 0:
+        i += 1
+    while j < len(b) and b[j] >= 0:
+        j += 1
+    if i + j == 0:
+        return 1.0
+    return common / (i + j - common)
+
+
+@numba.njit(parallel=True, cache=True)
+def _count_candidates(bank_amount, book_rows, book_amount, lo, hi, amount_tol, counts):
+    """Counts, per bank row, the book rows inside its date window that agree on amount."""
+    for i in numba.prange(len(counts)):
+        a = bank_amount[i]
+        n = 0
+        for k in range(lo[i], hi[i]):
+            if abs(a - book_amount[book_rows[k]]) <= amount_tol * abs(a):
+                n += 1
+        counts[i] = n
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _score(bank_amount, bank_tokens, book_rows, book_amount, book_tokens, lo, hi, offsets, amount_tol,
+           threshold, min_similarity, edge_bank, edge_book, edge_category, edge_score):
+    """Writes every (bank, book) candidate pair counted by _count_candidates, starting at
+    the bank row's offset. Pairs whose narrations are too far apart are marked RED."""
+    for i in numba.prange(len(offsets) - 1):
+        e = offsets[i]
+        a = bank_amount[i]
+        for k in range(lo[i], hi[i]):
+            j = book_rows[k]
+            # Narration only matters once the amount is within tolerance; anything
+            # further off is left to the LLM fallback
+            if abs(a - book_amount[j]) > amount_tol * abs(a):
+                continue
+            sim = _jaccard(bank_tokens[i], book_tokens[j])
+            edge_bank[e] = i
+            edge_book[e] = j
+            edge_score[e] = sim
+            if sim < min_similarity:
+                edge_category[e] = RED
+            else:
+                edge_category[e] = GREEN if sim >= threshold else YELLOW
+            e += 1
+
+
+@numba.njit(cache=True)
+def _assign(order, edge_bank, edge_book, edge_category, edge_score, best_book, best_category, best_score, taken):
+    """Takes the candidate pairs strongest first, keeping every row in at most one pair."""
+    for e in order:
+        i, j = edge_bank[e], edge_book[e]
+        if best_book[i] >= 0 or taken[j]:
+            continue
+        taken[j] = True
+        best_book[i] = j
+        best_category[i] = edge_category[e]
+        best_score[i] = edge_score[e]
+
+
+def match(bank_data: Dict[str, np.ndarray], book_data: Dict[str, np.ndarray], bank_columns: List[str],
+          book_columns: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Rule-based matching of bank rows against book rows.
+
+    Both sides are column-oriented tables; columns are given as [date, narration,
+    outflow, inflow]. Returns, per bank row, the matched book index (-1 if none),
+    the category (GREEN/YELLOW/RED) and the narration similarity.
+    """
+    bank_date, bank_narration, bank_out, bank_in = (_column(bank_data, col) for col in bank_columns)
+    book_date, book_narration, book_out, book_in = (_column(book_data, col) for col in book_columns)
+
+    bank_days, bank_valid = _to_days(bank_date)
+    book_days, book_valid = _to_days(book_date)
+    bank_amount = _to_amount(bank_out, bank_in)
+    book_amount = _to_amount(book_out, book_in)
+
+    vocab: Dict[str, int] = {}
+    bank_tokens = _narr_to_ids(bank_narration, vocab)
+    book_tokens = _narr_to_ids(book_narration, vocab)
+
+    # Sort book rows by date so each bank row's ±N day window is a contiguous slice
+    book_rows = np.flatnonzero(book_valid)
+    book_rows = book_rows[np.argsort(book_days[book_rows], kind="stable")]
+    sorted_days = book_days[book_rows]
+    lo = np.searchsorted(sorted_days, bank_days - DATE_WINDOW_DAYS, side="left")
+    hi = np.searchsorted(sorted_days, bank_days + DATE_WINDOW_DAYS, side="right")
+    hi[~bank_valid] = lo[~bank_valid]
+
+    n_bank = num_rows(bank_data)
+    best_book = np.full(n_bank, -1, dtype=np.int64)
+    best_category = np.full(n_bank, RED, dtype=np.uint8)
+    best_score = np.zeros(n_bank, dtype=np.float64)
+    taken = np.zeros(num_rows(book_data), dtype=np.bool_)
+
+    # Every candidate pair is scored once, then pairs are taken greedily, strongest first
+    # (green before yellow, then by similarity); a row whose best candidate is taken
+    # falls through to its next best one. Ties keep bank row order.
+    with _kernel_lock:
+        counts = np.empty(n_bank, dtype=np.int64)
+        _count_candidates(bank_amount, book_rows, book_amount, lo, hi, AMOUNT_TOLERANCE, counts)
+        offsets = np.zeros(n_bank + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        n_edges = offsets[-1]
+        edge_bank = np.empty(n_edges, dtype=np.int64)
+        edge_book = np.empty(n_edges, dtype=np.int64)
+        edge_category = np.empty(n_edges, dtype=np.uint8)
+        edge_score = np.empty(n_edges, dtype=np.float64)
+        _score(bank_amount, bank_tokens, book_rows, book_amount, book_tokens, lo, hi, offsets, AMOUNT_TOLERANCE,
+               NARRATION_THRESHOLD, MIN_NARRATION_SIMILARITY, edge_bank, edge_book, edge_category, edge_score)
+        candidates = np.flatnonzero(edge_category != RED)
+        order = candidates[np.lexsort((-edge_score[candidates], edge_category[candidates]))]
+        _assign(order, edge_bank, edge_book, edge_category, edge_score, best_book, best_category, best_score, taken)
+    return best_book, best_category, best_score
+
+
+def _buckets(days: np.ndarray, valid: np.ndarray) -> Dict[int, np.ndarray]:
+    """Groups the positions of dated rows by DATE_WINDOW_DAYS-wide bucket (like floor("5D")
+    on epoch days)."""
+    rows = np.flatnonzero(valid)
+    positions = pd.Series(rows).groupby(days[rows] // DATE_WINDOW_DAYS).indices
+    return {bucket: rows[pos] for bucket, pos in positions.items()}
+
+
+def _closest_in_amount(candidates: np.ndarray, amounts: np.ndarray, targets: np.ndarray, limit: int) -> np.ndarray:
+    """The `limit` candidate rows whose amount is closest to any of the target amounts."""
+    if len(candidates) <= limit:
+        return candidates
+    if not len(targets):
+        return candidates[:0]
+    targets = np.sort(targets)
+    values = amounts[candidates]
+    pos = np.searchsorted(targets, values)
+    below = np.abs(values - targets[np.clip(pos - 1, 0, len(targets) - 1)])
+    above = np.abs(values - targets[np.clip(pos, 0, len(targets) - 1)])
+    return candidates[np.argsort(np.minimum(below, above), kind="stable")[:limit]]
+
+
+def _amount_pieces(bank_idx: np.ndarray, book_idx: np.ndarray, bank_amount: np.ndarray, book_amount: np.ndarray,
+                   chunk_size: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Splits a group into pieces of at most `chunk_size` rows a side, by amount.
+
+    Candidates must agree on amount, so both sides are cut at the same amount values:
+    the larger side is cut into equal pieces and the other side is cut where those
+    pieces start. A cut inside a run of equal amounts cuts the other side's run of that
+    amount in the same proportion, so tied rows are spread over the pieces on both
+    sides. A piece of the smaller side that still ends up too big is split the same
+    way, with the roles swapped.
+    """
+    if len(bank_idx) <= chunk_size and len(book_idx) <= chunk_size:
+        return [(bank_idx, book_idx)]
+
+    bank_idx = bank_idx[np.argsort(bank_amount[bank_idx], kind="stable")]
+    book_idx = book_idx[np.argsort(book_amount[book_idx], kind="stable")]
+    bank_larger = len(bank_idx) >= len(book_idx)
+    large, large_amount = (bank_idx, bank_amount) if bank_larger else (book_idx, book_amount)
+    small, small_amount = (book_idx, book_amount) if bank_larger else (bank_idx, bank_amount)
+
+    large_pieces = np.array_split(large, -(-len(large) // chunk_size))
+    cut_pos = np.cumsum([len(piece) for piece in large_pieces[:-1]])
+    large_sorted, small_sorted = large_amount[large], small_amount[small]
+    cuts = large_sorted[cut_pos]
+    large_lo = np.searchsorted(large_sorted, cuts, side="left")
+    large_hi = np.searchsorted(large_sorted, cuts, side="right")
+    small_lo = np.searchsorted(small_sorted, cuts, side="left")
+    small_hi = np.searchsorted(small_sorted, cuts, side="right")
+    share = (cut_pos - large_lo) / (large_hi - large_lo)
+    small_pieces = np.split(small, small_lo + np.floor(share * (small_hi - small_lo) + 0.5).astype(np.int64))
+
+    pieces = []
+    for large_piece, small_piece in zip(large_pieces, small_pieces):
+        bank_piece, book_piece = (large_piece, small_piece) if bank_larger else (small_piece, large_piece)
+        pieces.extend(_amount_pieces(bank_piece, book_piece, bank_amount, book_amount, chunk_size))
+    return pieces
+
+
+def date_blocks(bank_data: Dict[str, np.ndarray], book_data: Dict[str, np.ndarray], bank_rows: np.ndarray, book_rows: np.ndarray,
+                bank_columns: List[str], book_columns: List[str], chunk_size: int) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Blocks rows on date for the LLM fallback, instead of pairing them by position.
+
+    Rows are bucketed into DATE_WINDOW_DAYS-wide blocks and adjacent buckets are merged
+    until a side reaches `chunk_size` rows. Each chunk also gets the book rows of the
+    bucket on either side, so ±N day matches across a bucket edge aren't missed. Busy
+    dates (salary day, month end) are split further by amount, so no chunk has more
+    than `chunk_size` rows on either side, plus at most `chunk_size` neighbors, the
+    ones closest in amount. Columns are given as [date, narration, outflow, inflow].
+
+    Returns (bank_idx, book_idx, neighbor_idx) per chunk, taken from `bank_rows`/
+    `book_rows`; every book row is in exactly one book_idx. A neighbor can be in
+    several chunks, so the caller must keep its matches one-to-one. Rows without a
+    parseable date are chunked by position at the end.
+    """
+    bank_date, _, bank_out, bank_in = (_column(bank_data, col) for col in bank_columns)
+    book_date, _, book_out, book_in = (_column(book_data, col) for col in book_columns)
+    bank_amount = _to_amount(bank_out, bank_in)
+    book_amount = _to_amount(book_out, book_in)
+
+    bank_days, bank_valid = _to_days(bank_date[bank_rows])
+    book_days, book_valid = _to_days(book_date[book_rows])
+    bank_by = {bucket: bank_rows[pos] for bucket, pos in _buckets(bank_days, bank_valid).items()}
+    book_by = {bucket: book_rows[pos] for bucket, pos in _buckets(book_days, book_valid).items()}
+    empty = np.empty(0, dtype=np.int64)
+
+    groups, current, n_bank, n_book = [], [], 0, 0
+    for bucket in sorted(set(bank_by) | set(book_by)):
+        current.append(bucket)
+        n_bank += len(bank_by.get(bucket, empty))
+        n_book += len(book_by.get(bucket, empty))
+        if n_bank >= chunk_size or n_book >= chunk_size:
+            groups.append(current)
+            current, n_bank, n_book = [], 0, 0
+    if current:
+        groups.append(current)
+
+    chunks = []
+    for group in groups:
+        bank_idx = np.concatenate([bank_by.get(b, empty) for b in group])
+        book_idx = np.concatenate([book_by.get(b, empty) for b in group])
+        neighbor_idx = np.concatenate([book_by.get(group[0] - 1, empty), book_by.get(group[-1] + 1, empty)])
+
+        for bank_piece, book_piece in _amount_pieces(bank_idx, book_idx, bank_amount, book_amount, chunk_size):
+            neighbors = _closest_in_amount(neighbor_idx, book_amount, bank_amount[bank_piece], chunk_size)
+            chunks.append((bank_piece, book_piece, neighbors))
+
+    undated_bank = bank_rows[~bank_valid]
+    undated_book = book_rows[~book_valid]
+    for start in range(0, max(len(undated_bank), len(undated_book)), chunk_size):
+        chunks.append((undated_bank[start:start + chunk_size], undated_book[start:start + chunk_size], empty))
+    return chunks
+
+
+def _warm_up():
+    """Compiles (or loads from cache) the Numba kernels with the exact types match() uses,
+    so the first upload doesn't pay for JIT compilation."""
+    columns = ["date", "narration", "outflow", "inflow"]
+    data = {
+        "date": np.array(["2024-01-01"], dtype=object),
+        "narration": np.array(["warm up"], dtype=object),
+        "outflow": np.array([1.0]),
+        "inflow": np.array([0.0]),
+    }
+    match(data, data, columns, columns)
+
+
+_warm_up()
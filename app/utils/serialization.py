@@ -0,0 +1,12 @@
+from datetime import datetime
+import orjson
+
+def json_default(obj):
+    """orjson fallback: pandas Timestamps (a datetime subclass orjson skips) as ISO 8601, anything else as str."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
+def dumps(obj, option: int = 0) -> bytes:
+    """Serializes to JSON with orjson, including numpy values and pandas Timestamps."""
+    return orjson.dumps(obj, option=option | orjson.OPT_SERIALIZE_NUMPY, default=json_default)
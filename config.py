@@ -5,4 +5,5 @@ load_dotenv()
 
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key'
-    UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads') 
\ No newline at end of file
+    UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+    CACHE_FOLDER = os.environ.get('CACHE_FOLDER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
\ No newline at end of file
@@ -0,0 +1,279 @@
+import io
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+# The caches live under CACHE_FOLDER, which config reads at import time
+os.environ.setdefault("CACHE_FOLDER", tempfile.mkdtemp())
+
+import numpy as np
+import orjson
+import pandas as pd
+from werkzeug.datastructures import FileStorage
+
+from app.services import ai_service
+from app.services.file_processor import ReconciliationProcessor
+
+BANK_CSV = b"Date,Narration,Withdrawal Amt.,Deposit Amt.\n2024-03-07,O'Brien rent,1000,\n"
+BOOK_CSV = b"date,transaction_details,debit,credit\n2024-03-07,rent,1000,\n"
+
+
+class CsvRoundTripTest(unittest.TestCase):
+    def test_ai_echo_of_pyarrow_dates_maps_back_to_the_rows(self):
+        bank_data, book_data = ReconciliationProcessor()._load_data(
+            FileStorage(io.BytesIO(BANK_CSV), filename="bank.csv"),
+            FileStorage(io.BytesIO(BOOK_CSV), filename="book.csv"),
+        )
+        bank_chunk = ai_service.matcher.to_rows(bank_data, [0])
+        book_chunk = ai_service.matcher.to_rows(book_data, [0])
+
+        # The AI echoes the rows exactly as they were serialized into the prompt
+        service = ai_service.AIReconciliationService()
+        prompt = service._create_matching_prompt(bank_chunk, book_chunk)
+        bank_rows = orjson.loads(prompt.split("Bank Transactions:\n")[1].split("\n")[0])["rows"]
+        book_rows = orjson.loads(prompt.split("Book Transactions:\n")[1].split("\n")[0])["rows"]
+        response = orjson.loads(orjson.dumps({
+            "green": [{"bank": bank_rows[0], "book": book_rows[0]}],
+            "yellow": [],
+            "red": {"bank": [], "book": []},
+        }))
+
+        result = service._from_table(response, bank_chunk, book_chunk)
+        self.assertEqual(result["red"], [])
+        self.assertIs(result["green"][0]["bank"], bank_chunk[0])
+        self.assertIs(result["green"][0]["book"], book_chunk[0])
+
+
+class RequiredColumnsTest(unittest.TestCase):
+    def read(self, content, filename):
+        return ReconciliationProcessor()._read_file(FileStorage(io.BytesIO(content), filename=filename), ai_service.BANK_COLUMNS)
+
+    def test_only_required_columns_are_read(self):
+        df = self.read(b"Date,Narration,Ref,Withdrawal Amt.\n2024-03-07,rent,R1,1000\n", "bank.csv")
+
+        self.assertEqual(list(df.columns), ["Date", "Narration", "Withdrawal Amt."])
+
+    def test_csv_without_any_required_column_is_rejected(self):
+        with self.assertRaisesRegex(Exception, "none of the columns"):
+            self.read(b"when,what\n2024-03-07,rent\n", "bank.csv")
+
+    def test_excel_without_any_required_column_is_rejected(self):
+        content = io.BytesIO()
+        pd.DataFrame({"when": ["2024-03-07"], "what": ["rent"]}).to_excel(content, index=False)
+
+        with self.assertRaisesRegex(Exception, "none of the columns"):
+            self.read(content.getvalue(), "bank.xlsx")
+
+
+class FromTableTest(unittest.TestCase):
+    def setUp(self):
+        self.service = ai_service.AIReconciliationService()
+        self.bank_chunk = [{"Date": "2024-03-07", "Narration": "rent", "Withdrawal Amt.": 1000.0, "Deposit Amt.": None}]
+        self.book_chunk = [{"date": "2024-03-07", "transaction_details": "rent", "debit": 1000.0, "credit": None}]
+
+    def test_pair_cut_off_before_its_book_row_is_dropped(self):
+        raw = '{"green": [{"bank": ["2024-03-07", "rent", 1000.0, null],'
+        result = self.service._from_table(self.service._parse_response(raw, 0), self.bank_chunk, self.book_chunk)
+
+        self.assertEqual(result["green"], [])
+        self.assertEqual(result["red"], self.bank_chunk + self.book_chunk)
+
+
+def bank_row(narration, amount):
+    return {"Date": "2024-03-07", "Narration": narration, "Withdrawal Amt.": amount, "Deposit Amt.": None}
+
+
+def book_row(narration, amount):
+    return {"date": "2024-03-07", "transaction_details": narration, "debit": amount, "credit": None}
+
+
+class FakeChatClient:
+    """Stands in for the OpenAI client's chat completions, answering with `answers` in turn."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **request):
+        self.requests.append(request)
+        message = SimpleNamespace(content=self.answers.pop(0), refusal=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class ProcessChunkTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        ai_service._response_cache.clear()
+        self.service = ai_service.AIReconciliationService()
+        self.bank_chunk = [bank_row("rent", 1000.0)]
+        self.book_chunk = [book_row("rent", 1000.0)]
+        self.key = ai_service._cache_key(self.service._chat_request(
+            self.service._create_matching_prompt(self.bank_chunk, self.book_chunk)))
+        self.valid = orjson.dumps({"green": [{"bank": ["2024-03-07", "rent", 1000.0, None],
+                                              "book": ["2024-03-07", "rent", 1000.0, None]}],
+                                   "yellow": [], "red": {"bank": [], "book": []}}).decode()
+
+    async def process(self, answers):
+        client = FakeChatClient(answers)
+        with mock.patch.object(ai_service, "_openai_client", return_value=client):
+            result = await self.service.process_chunk(self.bank_chunk, self.book_chunk, 0)
+        return result, client
+
+    async def test_answer_is_cached(self):
+        await self.process([self.valid])
+
+        result, client = await self.process([])
+
+        self.assertEqual(client.requests, [])
+        self.assertEqual(len(result["green"]), 1)
+
+    async def test_invalid_json_is_evicted_and_retried_strictly(self):
+        result, client = await self.process(["I matched them all", self.valid])
+
+        self.assertEqual(len(result["green"]), 1)
+        self.assertEqual([request["temperature"] for request in client.requests], [0.2, 0])
+        self.assertEqual(ai_service._response_cache.get(self.key), self.valid)
+
+    async def test_answer_in_the_wrong_layout_is_evicted_and_retried(self):
+        result, client = await self.process(['{"green": 5, "yellow": [], "red": {}}', self.valid])
+
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(len(result["green"]), 1)
+        self.assertEqual(ai_service._response_cache.get(self.key), self.valid)
+
+    async def test_chunk_fails_when_the_retry_is_invalid_too(self):
+        result, client = await self.process(["not json", "still not json"])
+
+        self.assertIsNone(result)
+        self.assertIsNone(ai_service._response_cache.get(self.key))
+
+
+class ExpandDuplicatesTest(unittest.TestCase):
+    def setUp(self):
+        self.service = ai_service.AIReconciliationService()
+
+    def test_pair_repeats_as_often_as_both_sides_have_copies(self):
+        rent, fee = bank_row("rent", 1000.0), book_row("fee", 5.0)
+        book_rent = book_row("rent", 1000.0)
+        result = {"green": [{"bank": rent, "book": book_rent}], "yellow": [], "red": [fee]}
+
+        expanded = self.service._expand_duplicates(result, [rent, rent], [book_rent, book_rent, fee])
+
+        self.assertEqual(expanded["green"], [{"bank": rent, "book": book_rent}] * 2)
+        self.assertEqual(expanded["red"], [fee])
+
+    def test_copies_left_over_on_one_side_are_unmatched(self):
+        rent, book_rent = bank_row("rent", 1000.0), book_row("rent", 1000.0)
+        result = {"green": [{"bank": rent, "book": book_rent}], "yellow": [], "red": []}
+
+        expanded = self.service._expand_duplicates(result, [rent, rent, rent], [book_rent])
+
+        self.assertEqual(expanded["green"], [{"bank": rent, "book": book_rent}])
+        self.assertEqual(expanded["red"], [rent, rent])
+
+    def test_red_rows_repeat_for_every_copy(self):
+        atm = bank_row("atm", 2000.0)
+        result = {"green": [], "yellow": [], "red": [atm]}
+
+        expanded = self.service._expand_duplicates(result, [atm, atm], [book_row("rent", 1000.0)])
+
+        self.assertEqual(expanded["red"], [atm, atm])
+
+    def test_identical_rows_can_pair_with_different_rows(self):
+        atm = bank_row("atm", 2000.0)
+        first, second = book_row("atm cash", 2000.0), book_row("cash atm", 2000.0)
+        result = {"green": [{"bank": atm, "book": first}, {"bank": atm, "book": second}], "yellow": [], "red": []}
+
+        expanded = self.service._expand_duplicates(result, [atm, atm], [first, second])
+
+        self.assertEqual(expanded["green"], result["green"])
+        self.assertEqual(expanded["red"], [])
+
+    def test_pairs_beyond_a_rows_copies_are_dropped(self):
+        rent = bank_row("rent", 1000.0)
+        first, second = book_row("rent", 1000.0), book_row("rent march", 1000.0)
+        result = {"green": [{"bank": rent, "book": first}, {"bank": rent, "book": second}], "yellow": [], "red": []}
+
+        expanded = self.service._expand_duplicates(result, [rent], [first, second])
+
+        self.assertEqual(expanded["green"], [{"bank": rent, "book": first}])
+        self.assertEqual(expanded["red"], [second])
+
+
+class OneToOneTest(unittest.TestCase):
+    def setUp(self):
+        self.service = ai_service.AIReconciliationService()
+        self.book = book_row("rent", 1000.0)
+        self.first, self.second = bank_row("rent", 1000.0), bank_row("rent payment", 1000.0)
+        # The book row belongs to the first chunk and is a neighbor of the second
+        self.chunks = [([self.first], [self.book], []), ([self.second], [], [self.book])]
+
+    def test_owning_chunk_wins_a_tie(self):
+        results = [
+            {"green": [{"bank": self.first, "book": self.book}], "yellow": [], "red": []},
+            {"green": [{"bank": self.second, "book": self.book}], "yellow": [], "red": []},
+        ]
+
+        self.service._one_to_one(results, self.chunks, [])
+
+        self.assertEqual(len(results[0]["green"]), 1)
+        self.assertEqual(results[1]["green"], [])
+        self.assertEqual(results[1]["red"], [self.second])
+
+    def test_green_beats_yellow(self):
+        results = [
+            {"green": [], "yellow": [{"bank": self.first, "book": self.book}], "red": []},
+            {"green": [{"bank": self.second, "book": self.book}], "yellow": [], "red": []},
+        ]
+
+        self.service._one_to_one(results, self.chunks, [])
+
+        self.assertEqual(results[0]["yellow"], [])
+        self.assertEqual(results[0]["red"], [self.first])
+        self.assertEqual(len(results[1]["green"]), 1)
+
+
+class CombineResultsTest(unittest.TestCase):
+    def test_red_rows_are_output_as_given(self):
+        row = {"Date": pd.Timestamp("2024-03-07"), "Narration": "atm", "Withdrawal Amt.": 2000.0, "Deposit Amt.": None}
+
+        combined = ai_service.AIReconciliationService()._combine_results([{"green": [], "yellow": [], "red": [row, dict(row)]}])
+
+        self.assertIs(combined["red"][0], row)
+        self.assertEqual(list(combined["red"][1]), list(row))
+        self.assertEqual(len(combined["red"]), 2)
+
+
+class ResultRecordsTest(unittest.TestCase):
+    def test_records_hold_the_row_numbers_of_every_result(self):
+        bank_data = {
+            "Date": np.array(["2024-03-07", "2024-03-07", "2024-03-07"], dtype=object),
+            "Narration": np.array(["rent march", "atm cash", "atm cash"], dtype=object),
+            "Withdrawal Amt.": np.array([1000.0, 2000.0, 2000.0]),
+            "Deposit Amt.": np.array([np.nan] * 3),
+        }
+        book_data = {
+            "date": np.array(["2024-03-07", "2024-04-20"], dtype=object),
+            "transaction_details": np.array(["rent march", "misc"], dtype=object),
+            "debit": np.array([1000.0, 5000.0]),
+            "credit": np.array([np.nan] * 2),
+        }
+        service = ai_service.AIReconciliationService()
+        matched, chunks, positions = service._rule_based_pass(bank_data, book_data)
+
+        # The AI fails on the chunk of the ATM rows, so they stay unmatched
+        results = service._finish(matched, chunks, [None] * len(chunks), positions, "records-test")
+
+        self.assertEqual(results["job_id"], "records-test")
+        records = pd.read_parquet(os.path.join(ai_service.RESULTS_FOLDER, "records-test.parquet"))
+        self.assertEqual(list(records.columns), list(ai_service.RESULT_DTYPE.names))
+        rows = sorted(zip(records["bank_idx"], records["book_idx"], records["category"]))
+        self.assertEqual(rows, [(-1, 1, ai_service.matcher.RED), (0, 0, ai_service.matcher.GREEN),
+                                (1, -1, ai_service.matcher.RED), (2, -1, ai_service.matcher.RED)])
+        self.assertAlmostEqual(records["score"][records["category"] == ai_service.matcher.GREEN].iloc[0], 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import unittest
+
+# The caches live under CACHE_FOLDER, which config reads at import time
+os.environ.setdefault("CACHE_FOLDER", tempfile.mkdtemp())
+
+import numpy as np
+
+from app.services import matcher
+
+COLUMNS = ["date", "narration", "outflow", "inflow"]
+
+
+def table(dates, amounts, narrations=None):
+    """A column-oriented table of withdrawals."""
+    return {
+        "date": np.array(dates, dtype=object),
+        "narration": np.array(narrations or ["payment"] * len(dates), dtype=object),
+        "outflow": np.array(amounts, dtype=np.float64),
+        "inflow": np.zeros(len(dates)),
+    }
+
+
+class MatchTest(unittest.TestCase):
+    def match(self, bank, book):
+        return matcher.match(bank, book, COLUMNS, COLUMNS)
+
+    def test_date_window(self):
+        bank = table(["2024-03-10", "2024-03-10"], [100.0, 200.0], ["rent march", "salary march"])
+        book = table(["2024-03-05", "2024-03-16"], [100.0, 200.0], ["rent march", "salary march"])
+
+        book_idx, category, _ = self.match(bank, book)
+
+        self.assertEqual(list(book_idx), [0, -1])
+        self.assertEqual(list(category), [matcher.GREEN, matcher.RED])
+
+    def test_amount_tolerance(self):
+        bank = table(["2024-03-10"] * 2, [10000.0, 20000.0], ["rent march", "salary march"])
+        book = table(["2024-03-10"] * 2, [10004.0, 20100.0], ["rent march", "salary march"])
+
+        book_idx, category, _ = self.match(bank, book)
+
+        # 0.04% is within ±0.05%; 0.5% is left to the AI
+        self.assertEqual(list(book_idx), [0, -1])
+        self.assertEqual(list(category), [matcher.GREEN, matcher.RED])
+
+    def test_narration_similarity_decides_green_yellow_or_none(self):
+        bank = table(["2024-03-10"] * 3, [100.0, 200.0, 300.0],
+                     ["acme supplies invoice", "acme supplies payment", "acme supplies"])
+        book = table(["2024-03-10"] * 3, [100.0, 200.0, 300.0],
+                     ["acme supplies invoice", "acme supplies invoice march", "unrelated transfer"])
+
+        book_idx, category, score = self.match(bank, book)
+
+        self.assertEqual(list(book_idx), [0, 1, -1])
+        self.assertEqual(list(category), [matcher.GREEN, matcher.YELLOW, matcher.RED])
+        self.assertAlmostEqual(score[1], 0.4)  # 2 shared tokens of 5
+
+    def test_loser_takes_its_next_best_candidate(self):
+        # Both bank rows prefer book row 0; the weaker one falls back to book row 1
+        bank = table(["2024-03-10"] * 2, [100.0, 100.0], ["acme rent march", "acme rent"])
+        book = table(["2024-03-10"] * 2, [100.0, 100.0], ["acme rent march", "acme rent april"])
+
+        book_idx, category, _ = self.match(bank, book)
+
+        self.assertEqual(list(book_idx), [0, 1])
+        self.assertEqual(list(category), [matcher.GREEN, matcher.YELLOW])
+
+    def test_each_book_row_is_matched_once(self):
+        bank = table(["2024-03-10"] * 3, [100.0] * 3, ["rent"] * 3)
+        book = table(["2024-03-10"] * 2, [100.0] * 2, ["rent"] * 2)
+
+        book_idx, category, _ = self.match(bank, book)
+
+        self.assertEqual(sorted(book_idx), [-1, 0, 1])
+        self.assertEqual(sorted(category), [matcher.GREEN, matcher.GREEN, matcher.RED])
+
+    def test_hundreds_of_tied_rows_are_matched_one_to_one(self):
+        bank = table(["2024-03-10"] * 300, [100.0] * 300, ["atm cash"] * 300)
+        book = table(["2024-03-10"] * 300, [100.0] * 300, ["atm cash"] * 300)
+
+        book_idx, category, _ = self.match(bank, book)
+
+        self.assertEqual(sorted(book_idx), list(range(300)))
+        self.assertTrue((category == matcher.GREEN).all())
+
+
+class DateBlocksTest(unittest.TestCase):
+    def blocks(self, bank, book, chunk_size):
+        return matcher.date_blocks(bank, book, np.arange(matcher.num_rows(bank)), np.arange(matcher.num_rows(book)),
+                                   COLUMNS, COLUMNS, chunk_size)
+
+    def test_imbalanced_busy_day_keeps_equal_amounts_together(self):
+        bank = table(["2024-03-01"] * 100, np.arange(1, 101))
+        book = table(["2024-03-01"] * 10, np.arange(91, 101))
+
+        chunks = self.blocks(bank, book, 50)
+
+        self.assertEqual(len(chunks), 2)
+        for bank_idx, book_idx, _ in chunks:
+            self.assertLessEqual(len(bank_idx), 50)
+            self.assertLessEqual(len(book_idx), 50)
+            bank_amounts = set(bank["outflow"][bank_idx])
+            self.assertTrue(set(book["outflow"][book_idx]) <= bank_amounts)
+        self.assertEqual(sorted(np.concatenate([book_idx for _, book_idx, _ in chunks])), list(range(10)))
+
+    def test_smaller_side_piece_that_is_too_big_is_split_again(self):
+        bank = table(["2024-03-01"] * 100, np.arange(1, 101))
+        book = table(["2024-03-01"] * 80, [95.0] * 80)
+
+        chunks = self.blocks(bank, book, 50)
+
+        for bank_idx, book_idx, _ in chunks:
+            self.assertLessEqual(len(bank_idx), 50)
+            self.assertLessEqual(len(book_idx), 50)
+        self.assertEqual(sorted(np.concatenate([book_idx for _, book_idx, _ in chunks])), list(range(80)))
+
+    def test_ties_on_both_sides_are_spread_over_the_pieces(self):
+        bank = table(["2024-03-01"] * 100, [95.0] * 100)
+        book = table(["2024-03-01"] * 80, [95.0] * 80)
+
+        chunks = self.blocks(bank, book, 50)
+
+        self.assertEqual([(len(bank_idx), len(book_idx)) for bank_idx, book_idx, _ in chunks], [(50, 40), (50, 40)])
+
+    def test_neighbors_are_the_closest_in_amount_from_the_adjacent_buckets(self):
+        bank = table(["2024-03-06"], [100.0])
+        book = table(["2024-03-01", "2024-03-06", "2024-03-11", "2024-03-30"], [90.0, 100.0, 100.5, 100.0])
+
+        # Chunk size 1 keeps every bucket in a group of its own, with one neighbor
+        chunks = self.blocks(bank, book, 1)
+
+        bank_chunk = [chunk for chunk in chunks if len(chunk[0])]
+        self.assertEqual(len(bank_chunk), 1)
+        _, book_idx, neighbor_idx = bank_chunk[0]
+        self.assertEqual(list(book_idx), [1])
+        self.assertEqual(list(neighbor_idx), [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+import io
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+# The caches live under CACHE_FOLDER, which config reads at import time
+os.environ.setdefault("CACHE_FOLDER", tempfile.mkdtemp())
+
+import orjson
+from werkzeug.datastructures import FileStorage
+
+from app import create_app
+from app.routes import main
+from app.services import ai_service
+
+# Same day, but the amounts differ by a bank charge, so the rules leave the pair to the AI
+BANK_CSV = b"Date,Narration,Withdrawal Amt.,Deposit Amt.\n2024-01-10,UPI/RAJ TRADERS/PAYMENT,5008.5,\n"
+BOOK_CSV = b"date,transaction_details,debit,credit\n2024-01-10,Raj Traders,5000,\n"
+
+
+def upload_files():
+    return {
+        "bank_statement": FileStorage(io.BytesIO(BANK_CSV), filename="bank.csv"),
+        "company_book": FileStorage(io.BytesIO(BOOK_CSV), filename="book.csv"),
+    }
+
+
+def chat_body(content, refusal=None):
+    return {"choices": [{"message": {"content": content, "refusal": refusal}}], "usage": {"prompt_tokens": 1}}
+
+
+def yellow_answer(prompt):
+    """An AI answer that matches the first bank row of the prompt with its first book row."""
+    bank_rows = orjson.loads(prompt.split("Bank Transactions:\n")[1].split("\n")[0])["rows"]
+    book_rows = orjson.loads(prompt.split("Book Transactions:\n")[1].split("\n")[0])["rows"]
+    return orjson.dumps({"yellow": [{"bank": bank_rows[0], "book": book_rows[0]}], "green": [],
+                         "red": {"bank": [], "book": []}}).decode()
+
+
+class FakeBatchClient:
+    """Stands in for the OpenAI client's files and batches endpoints."""
+
+    def __init__(self, batch_id):
+        self.requests = []
+        self.batch = SimpleNamespace(id=batch_id, status="in_progress", output_file_id=None)
+        self.output = b""
+        self.files = SimpleNamespace(create=self.create_file, content=self.file_content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve_batch)
+
+    async def create_file(self, file, purpose):
+        self.requests = [orjson.loads(line) for line in file[1].splitlines()]
+        return SimpleNamespace(id="file-in")
+
+    async def file_content(self, file_id):
+        return SimpleNamespace(content=self.output)
+
+    async def create_batch(self, **kwargs):
+        return self.batch
+
+    async def retrieve_batch(self, batch_id):
+        return self.batch
+
+    def finish(self, status, bodies):
+        self.batch.status, self.batch.output_file_id = status, "file-out"
+        self.output = b"\n".join(
+            orjson.dumps({"custom_id": str(index), "response": {"status_code": 200, "body": body}})
+            for index, body in enumerate(bodies)
+        )
+
+    def prompt(self, index):
+        return self.requests[index]["body"]["messages"][1]["content"]
+
+
+class JsonResponseTest(unittest.IsolatedAsyncioTestCase):
+    async def respond(self, results):
+        app = create_app()
+        async with app.test_request_context("/"):
+            response = main.json_response(results)
+            body = b"".join([part async for part in response.response])
+        return response, body
+
+    async def test_large_results_are_streamed(self):
+        results = {"green": [{"bank": {"Date": "2024-03-07"}, "book": {"date": "2024-03-07"}}] * (main.STREAM_THRESHOLD + 1),
+                   "yellow": [], "red": [{"Narration": "atm"}], "job_id": "abc"}
+
+        response, body = await self.respond(results)
+
+        self.assertIsNone(response.content_length)  # No length up front: the body is streamed
+        self.assertEqual(orjson.loads(body), results)
+
+    async def test_small_results_are_sent_in_one_piece(self):
+        results = {"green": [], "yellow": [], "red": [{"Narration": "atm"}], "job_id": "abc"}
+
+        response, body = await self.respond(results)
+
+        self.assertEqual(orjson.loads(body), results)
+        self.assertEqual(response.content_length, len(body))
+
+
+class FakeChatClient:
+    """Stands in for the OpenAI client's chat completions; `answer` turns a prompt into
+    the answer's content, or None for a refusal."""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **request):
+        self.calls += 1
+        content = self.answer(request["messages"][1]["content"])
+        message = SimpleNamespace(content=content, refusal=None if content else "I can't help with that")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class UploadCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        main._reconcile_cache.clear()
+        ai_service._response_cache.clear()
+        self.client = create_app().test_client()
+
+    async def upload(self, openai):
+        with mock.patch.object(ai_service, "_openai_client", return_value=openai):
+            response = await self.client.post("/api/upload", files=upload_files())
+        self.assertEqual(response.status_code, 200)
+        return await response.get_json()
+
+    async def test_same_files_return_the_earlier_results(self):
+        openai = FakeChatClient(yellow_answer)
+        first = await self.upload(openai)
+        # Without the AI's cached answer, a second reconciliation would have to ask again
+        ai_service._response_cache.clear()
+
+        second = await self.upload(openai)
+
+        self.assertEqual(openai.calls, 1)
+        self.assertEqual(second, first)
+        self.assertEqual(len(second["yellow"]), 1)
+
+    async def test_results_with_failed_chunks_are_not_cached(self):
+        openai = FakeChatClient(lambda prompt: None)
+        first = await self.upload(openai)
+
+        second = await self.upload(openai)
+
+        self.assertEqual(openai.calls, 2)
+        self.assertEqual(len(first["red"]), 2)
+        self.assertEqual(len(second["red"]), 2)
+        self.assertEqual(len(main._reconcile_cache), 0)
+
+
+class BatchRoutesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = create_app().test_client()
+        self.openai = FakeBatchClient(f"batch-{self.id()}")
+        patcher = mock.patch.object(ai_service, "_openai_client", return_value=self.openai)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def submit(self):
+        response = await self.client.post("/api/upload", files=upload_files(), form={"mode": "batch"})
+        self.assertEqual(response.status_code, 202)
+        return (await response.get_json())["batch_id"]
+
+    async def test_running_batch_is_polled_again(self):
+        batch_id = await self.submit()
+
+        response = await self.client.get(f"/api/results/{batch_id}")
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((await response.get_json())["status"], "in_progress")
+
+    async def test_completed_batch_returns_the_ai_matches(self):
+        batch_id = await self.submit()
+        self.openai.finish("completed", [chat_body(yellow_answer(self.openai.prompt(0)))])
+
+        response = await self.client.get(f"/api/results/{batch_id}")
+
+        self.assertEqual(response.status_code, 200)
+        results = await response.get_json()
+        self.assertEqual(len(results["yellow"]), 1)
+        self.assertEqual(results["red"], [])
+        self.assertEqual(results["job_id"], batch_id)
+        self.assertNotIn("failed_chunks", results)
+
+    async def test_refused_chunk_is_red_and_flagged(self):
+        batch_id = await self.submit()
+        self.openai.finish("completed", [chat_body(None, refusal="I can't help with that")])
+
+        response = await self.client.get(f"/api/results/{batch_id}")
+
+        self.assertEqual(response.status_code, 200)
+        results = await response.get_json()
+        self.assertEqual(len(results["red"]), 2)
+        self.assertEqual(results["failed_chunks"], 1)
+
+    async def test_expired_batch_keeps_its_output_and_is_flagged(self):
+        batch_id = await self.submit()
+        self.openai.finish("expired", [chat_body(yellow_answer(self.openai.prompt(0)))])
+
+        response = await self.client.get(f"/api/results/{batch_id}")
+
+        results = await response.get_json()
+        self.assertEqual(len(results["yellow"]), 1)
+        self.assertEqual(results["batch_status"], "expired")
+        self.assertEqual(results["failed_chunks"], 0)
+
+    async def test_unknown_batch(self):
+        response = await self.client.get("/api/results/batch-unknown")
+
+        self.assertEqual(response.status_code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()